@@ -4,8 +4,14 @@ import sys
 import os
 import re
 import logging
-from copy import deepcopy
+import threading
+from multiprocessing.pool import ThreadPool
 
+try:
+    # Optional, serializes large tenant configs much faster than json.dumps
+    import orjson
+except ImportError:
+    orjson = None
 
 # Add lib directory to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'acitoolkit'))
@@ -20,6 +26,43 @@ class bcolors:
     ENDC = '\033[0m'
 
 
+# Line written by print_migration, with the colors already filled in
+MIGRATION_LINE = ('{0} ' + bcolors.RED + '{1}' + bcolors.ENDC + ' with key ' + bcolors.BLUE + '{2}' + bcolors.ENDC +
+                  ' in ' + bcolors.GREEN + '{3}/{4}/{5}{6}' + bcolors.ENDC + '\n')
+
+# Suffix of the backup made of each 1.2 interface folder during migration
+PREMIGRATION = '_premigration'
+
+# DP 1.2 interface subfolder keys and their DP 1.3 replacements
+SUBFOLDER_KEYS = {
+    'Layer3InterfaceConfig': 'Layer3Interface',
+    'Layer2InterfaceConfig': 'Layer2Interface',
+}
+
+# Relations from clusters, devmgrs and chassis to the device package
+CLUSTER_CLASSES = ('vnsRsMDevAtt', 'vnsRsDevMgrToMDevMgr', 'vnsRsChassisToMChassis', 'vnsRsMetaIf',
+                   'vnsRsMConnAtt', 'vnsRsNodeToAbsFuncProf', 'vnsRsNodeToMFunc')
+
+# Query for a tenant with its AppProfiles and cluster relations
+TENANT_QUERY = ('/api/mo/uni/tn-{0}.json?query-target=subtree&'
+                'target-subtree-class=fvTenant,fvAp,' + ','.join(CLUSTER_CLASSES))
+# Query for an AppProfile with its folders, params, and relations
+APP_QUERY = ('/api/mo/uni/tn-{0}/ap-{1}.json?query-target=self&rsp-subtree=full&'
+             'rsp-subtree-class=vnsFolderInst&rsp-prop-include=config-only')
+_cluster_classes = frozenset(CLUSTER_CLASSES)
+# Device package references in cluster relations, by device package version
+DP_REFERENCES = dict(
+    (version, re.compile(r"^uni/infra/(mDev|mDevMgr|mChassis)-PaloAltoNetworks-(PANOS|Panorama|Chassis)-" +
+                         re.escape(version)))
+    for version in ('1.2', '1.3'))
+
+# Most tenants to migrate at the same time when several are given
+MAX_TENANT_THREADS = 8
+
+# Children lists by object id and class for each thread, see _children()
+_child_cache = threading.local()
+
+
 def parse_args():
     description = 'Migrates APIC configuration for PANW Device Package 1.2 to 1.3'
     creds = aci.Credentials('apic', description)
@@ -28,11 +71,15 @@ def parse_args():
     commands.add_argument('--clusters', action='store_true', help='Trigger migration of clusters using migrated parameters')
     commands.add_argument('--revert', action='store_true', help='Switch clusters back to 1.2 device package')
     commands.add_argument('--cleanup', action='store_true', help='Clean up old 1.2 parameters after a migration. WARNING: cannot revert after a cleanup, use cleanup with caution!')
-    creds.add_argument('--tenant', help='Name of tenant to migrate (displays choices if not provided)')
+    creds.add_argument('--tenant', help='Name of tenant to migrate, or comma separated names to migrate clusters of several tenants in parallel (displays choices if not provided)')
     creds.add_argument('--app', help='Name of application profile to migrate (displays choices if not provided)')
     creds.add_argument('-n', '--dry-run', action='store_true', help='Do not make any changes to APIC, only print what would happen')
     creds.add_argument('-d', '--debug', action='store_true', help='Debug mode')
     args = creds.get()
+    if args.tenant and ',' in args.tenant and (args.app or args.parameters or args.cleanup):
+        print('Only --clusters can be used with more than one tenant.')
+        print('The --app, --parameters, and --cleanup arguments apply to one tenant at a time.')
+        sys.exit(1)
     if not args.tenant or not args.app:
         # Will fail and exit after printing tenants or apps
         return args
@@ -54,195 +101,238 @@ def parse_args():
     return args
 
 
-def print_object_names(objects, objtype):
+def print_object_names(names, objtype):
     print('\n{0} on APIC:\n'.format(objtype))
-    for obj in objects:
-        print('  {0}'.format(obj.name))
+    for name in names:
+        print('  {0}'.format(name))
 
 
 def print_migration(object, tenant, app, epg, other='', action='Migrating'):
     try:
-        key = object.keys()[0]
+        key = next(iter(object))
         obj = object[key]['attributes']['tCl']
-    except (AttributeError, KeyError):
+    except (TypeError, KeyError):
+        # Not an APIC json object, so an acitoolkit object
         key = getattr(object, 'key', 'n/a')
         obj = getattr(object, 'name', object)
-    print('{action} {oc}{obj}{endc} with key {kc}{key}{endc} in {lc}{tenant}/{app}/{epg}{other}{endc}'.format(
-        action=action,
-        obj=obj,
-        key=key,
-        tenant=tenant,
-        app=app,
-        epg=epg,
-        other=other,
-        oc=bcolors.RED,
-        kc=bcolors.BLUE,
-        lc=bcolors.GREEN,
-        endc=bcolors.ENDC,
-    ))
-
-
-def get_clusters(session, tenant=None):
-    query_target_type = 'subtree'
-    apic_class = 'vnsRsMDevAtt,vnsRsDevMgrToMDevMgr,vnsRsChassisToMChassis,vnsRsMetaIf,vnsRsMConnAtt,vnsRsNodeToAbsFuncProf,vnsRsNodeToMFunc'
-    if query_target_type not in ['self', 'children', 'subtree']:
-        raise ValueError
-    if isinstance(tenant, str):
-        raise TypeError
-    if tenant is None:
-        tenant_url = ''
-    else:
-        tenant_url = '/tn-%s' % tenant.name
-    query_url = ('/api/mo/uni%s.json?query-target=%s&'
-                 'target-subtree-class=%s' % (tenant_url, query_target_type, apic_class))
+    sys.stdout.write(MIGRATION_LINE.format(action, obj, key, tenant, app, epg, other))
+
+
+def _get_imdata(session, query_url):
+    """Get APIC imdata for a query, empty if nothing was found"""
     ret = session.get(query_url)
-    resp = []
-    if ret.ok:
-        data = ret.json()['imdata']
-        logging.debug('response returned %s', data)
-    else:
+    if not ret.ok:
         logging.error('Could not get %s. Received response: %s', query_url, ret.text)
-        return resp
+        return []
+    # Same escaped quote workaround as Tenant.get_deep
+    ret._content = ret._content.replace(b"\\\'", b"'")
+    data = ret.json()['imdata']
+    logging.debug('response returned %s', data)
     return data
 
 
-def migrate_interface_folder_keys(tenant, app_name):
-    """Migrate interface folder keys
+def get_tenant_config(session, tenant_name):
+    """Get a tenant, its AppProfiles, and its cluster relations from APIC in a single request
 
     Args:
-        tenant (aci.Tenant): The tenant to modify
-        app_name (str): Name of AppProfile
+        session (aci.Session): Logged in APIC session
+        tenant_name (str): Name of the tenant
 
     Returns:
-        bool: True if changes made, False if no changes made
+        list: APIC imdata for the tenant, empty if the tenant was not found
     """
-    changes_made = False
-    app = tenant.get_child(aci.AppProfile, app_name)
-    if not app:
-        print('Error getting AppProfile: {0}'.format(app_name))
-        return False
-    epgs = app.get_children(aci.EPG)
-    for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
-            if folder.key == 'InterfaceConfig' and not folder.name.endswith('_premigration'):
-                changes_made = True
-                print_migration(folder, tenant.name, app.name, epg.name)
-                # Copy the folder to make a backup
-                backup = deepcopy(folder)
-                backup.name = backup.name + '_premigration'
-                backup.ctrctNameOrLbl = backup.ctrctNameOrLbl + '_premigration'
-                epg.add_child(backup)
-                # Modify the folder it is DP 1.3 compatible
-                folder.key = 'Interface'
-                folder.name = folder.name
-                subfolders = folder.get_children(aci.Folder)
-                for subfolder in subfolders:
-                    if subfolder.key not in ('Layer3InterfaceConfig', 'Layer2InterfaceConfig'):
-                        continue
-                    print_migration(subfolder, tenant.name, app.name, epg.name, '/'+folder.name)
-                    # Strip 'Config' off the end of the key
-                    subfolder.key = subfolder.key[:15]
-    return changes_made
+    return _get_imdata(session, TENANT_QUERY.format(tenant_name))
 
 
-def migrate_ip(tenant, app_name):
-    """Migrate ip address
+def get_app_config(session, tenant_name, app_name):
+    """Get AppProfile folders, params, and relations from APIC
 
-    Args:
-        tenant (aci.Tenant): The tenant to modify
-        app_name (str): Name of AppProfile
+    Only the AppProfile being migrated is pulled, not every AppProfile in the tenant.
 
     Returns:
-        bool: True if changes made, False if no changes made
+        list: APIC imdata for the AppProfile, empty if it was not found
     """
-    changes_made = False
-    app = tenant.get_child(aci.AppProfile, app_name)
-    if not app:
-        print('Error getting AppProfile: {0}'.format(app_name))
-        return False
-    epgs = app.get_children(aci.EPG)
-    for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
-            if folder.key != 'Interface':
-                continue
-            layerfolders = folder.get_children(aci.Folder)
-            for layerfolder in layerfolders:
-                if layerfolder.key != 'Layer3Interface':
-                    continue
-                for param in layerfolder.get_children(aci.Parameter):
-                    if param.key != 'ipv4_address':
-                        continue
-                    print_migration(param, tenant.name, app.name, epg.name, '/'+folder.name+'/'+layerfolder.name)
-                    changes_made = True
-                    # Create new param with different key for IP
-                    new_ip = aci.Parameter('ip', layerfolder)
-                    new_ip.key = 'ip'
-                    new_ip.value = param.value
-                    param.mark_as_deleted()
-    return changes_made
+    return _get_imdata(session, APP_QUERY.format(tenant_name, app_name))
+
+
+def get_folder_keys(data, keys=None):
+    """Collect the keys of the EPG folders in get_app_config data
+
+    Used to skip migration passes that have no folders to work on. Folders
+    are not descended into, only the folders directly under EPGs are checked.
 
+    Returns:
+        set: Folder keys
+    """
+    if keys is None:
+        keys = set()
+    for mo in data:
+        for key, value in mo.items():
+            if key == 'vnsFolderInst':
+                keys.add(value['attributes'].get('key'))
+            else:
+                get_folder_keys(value.get('children', []), keys)
+    return keys
 
-def migrate_zones_and_vlans(tenant, app_name):
-    """Migrate zones and vlans
+
+def build_tenant(tenant_name, app_data):
+    """Build a Tenant holding only the AppProfile from get_app_config
 
     Args:
-        tenant (aci.Tenant): The tenant to modify
-        app_name (str): Name of AppProfile
+        tenant_name (str): Name of the tenant
+        app_data (list): AppProfile imdata from get_app_config
 
     Returns:
-        bool: True if changes made, False if no changes made
+        aci.Tenant: The tenant
     """
-    changes_made = False
-    app = tenant.get_child(aci.AppProfile, app_name)
-    if not app:
-        print('Error getting AppProfile: {0}'.format(app_name))
-        return False
-    epgs = app.get_children(aci.EPG)
-    for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
-            if folder.key != 'Interface':
-                continue
-            layerfolders = folder.get_children(aci.Folder)
-            for layerfolder in layerfolders:
-                if layerfolder.key not in ('Layer3Interface', 'Layer2Interface'):
-                    continue
-                for param in layerfolder.get_children(aci.Parameter):
-                    if param.key not in ('security_zone', 'bridge_domain'):
-                        continue
-                    print_migration(param, tenant.name, app.name, epg.name, '/'+folder.name+'/'+layerfolder.name)
-                    changes_made = True
-                    # Delete the current in-memory parameter
-                    #layerfolder.remove_child(param)
-                    param.mark_as_deleted()
-                    # Create a new Vlan or Zone folder
-                    new_folder = aci.Folder(param.value, epg)
-                    new_folder.ctrctNameOrLbl = folder.ctrctNameOrLbl
-                    new_folder.devCtxLbl = folder.devCtxLbl
-                    new_folder.graphNameOrLbl = folder.graphNameOrLbl
-                    new_folder.nodeNameOrLbl = folder.nodeNameOrLbl
-                    new_folder.scopedBy = folder.scopedBy
-                    new_ref_key = ''
-                    if param.key == 'bridge_domain':
-                        new_ref_key = 'vlan'
-                        new_folder.key = 'Vlan'
-                        # Create a reference to new folder
-                    elif param.key == 'security_zone':
-                        new_ref_key = 'zone'
-                        # For zones, add a mode parameter
-                        new_folder.key = 'Zone'
-                        layer = aci.Parameter('mode', new_folder)
-                        layer.key = 'mode'
-                        layer.value = layerfolder.key[:6].lower()  # 'layer3' or 'layer2'
-                    # Create relation layer folder to point at new folder
-                    relation = aci.Relation(param.key+'_rel', layerfolder)
-                    relation.key = new_ref_key
-                    relation.targetName = new_folder.name
-                    param.mark_as_deleted()
-    return changes_made
-                    
+    data = [{'fvTenant': {'attributes': {'name': tenant_name}, 'children': app_data}}]
+    # Same parsing Tenant.get_deep performs on the response it fetches itself
+    return super(aci.Tenant, aci.Tenant).get_deep(full_data=data, working_data=data,
+                                                  parent=aci.Fabric(), config_only=True)
+
+
+def get_app_names(data):
+    """Names of the AppProfiles in get_tenant_config data"""
+    return [mo['fvAp']['attributes']['name'] for mo in data if 'fvAp' in mo]
+
+
+def get_clusters(data):
+    """Cluster relations in get_tenant_config data, each with its full dn"""
+    return [mo for mo in data if next(iter(mo)) in _cluster_classes]
+
 
-def migrate_default_gateway(tenant, app_name):
-    """Migrate default gateway to static route
+def _children(obj, cls):
+    """Cached version of obj.get_children(cls)
+
+    The returned list is shared and must not be modified. It is a snapshot, so
+    after adding or removing children of obj, call _clear_children(obj) before
+    reading its children again. migrate_tenant() clears the whole cache after
+    each phase. The cache is per thread, so tenants migrated in parallel do not
+    share it.
+    """
+    try:
+        objects = _child_cache.objects
+    except AttributeError:
+        objects = _child_cache.objects = {}
+    entry = objects.get(id(obj))
+    if entry is None:
+        # Keep obj referenced so its id can't be reused while the entry exists
+        entry = objects[id(obj)] = (obj, {})
+    lists = entry[1]
+    if cls not in lists:
+        lists[cls] = obj.get_children(cls)
+    return lists[cls]
+
+
+def _clear_children(obj=None):
+    """Forget the cached children of obj, or of all objects if obj is None"""
+    if obj is None:
+        _child_cache.objects = {}
+    else:
+        getattr(_child_cache, 'objects', {}).pop(id(obj), None)
+
+
+def _clone_parameter(param, parent):
+    new_param = aci.Parameter(param.name, parent)
+    new_param.key = param.key
+    new_param.value = param.value
+    return new_param
+
+
+def _clone_relation(relation, parent):
+    new_relation = aci.Relation(relation.name, parent)
+    new_relation.key = relation.key
+    new_relation.targetName = relation.targetName
+    return new_relation
+
+
+def _clone_folder(folder, parent, name=None):
+    """Copy a folder and its parameters, relations and subfolders under parent
+
+    Cheaper than deepcopy, which also walks the parent EPG and tenant. Pass a
+    new name when copying under the same parent, acitoolkit replaces a child
+    with the same name instead of adding a second one.
+    """
+    new_folder = aci.Folder(name or folder.name, parent)
+    new_folder.key = folder.key
+    _copy_scope(folder, new_folder)
+    for param in _children(folder, aci.Parameter):
+        _clone_parameter(param, new_folder)
+    for relation in _children(folder, aci.Relation):
+        _clone_relation(relation, new_folder)
+    for subfolder in _children(folder, aci.Folder):
+        _clone_folder(subfolder, new_folder)
+    return new_folder
+
+
+def _restore_folder(folder, backup):
+    """Change folder in place to match backup
+
+    Children only in folder are marked as deleted, children only in backup are
+    copied into folder, and children in both are restored recursively. This
+    lets a folder be reverted in the same push that deletes its 1.3 children,
+    since both versions of the folder have the same dn.
+    """
+    folder.key = backup.key
+    backup_children = {}
+    for cls in (aci.Folder, aci.Parameter, aci.Relation):
+        for child in _children(backup, cls):
+            backup_children[(cls, child.name)] = child
+    for cls in (aci.Folder, aci.Parameter, aci.Relation):
+        for child in _children(folder, cls):
+            match = backup_children.pop((cls, child.name), None)
+            if match is None:
+                child.mark_as_deleted()
+            elif cls is aci.Folder:
+                _restore_folder(child, match)
+            elif cls is aci.Parameter:
+                child.key = match.key
+                child.value = match.value
+            else:
+                child.key = match.key
+                child.targetName = match.targetName
+    for (cls, _), child in backup_children.items():
+        if cls is aci.Folder:
+            _clone_folder(child, folder)
+        elif cls is aci.Parameter:
+            _clone_parameter(child, folder)
+        else:
+            _clone_relation(child, folder)
+    _clear_children(folder)
+
+
+def push_to_apic(session, url, data):
+    """Push data to APIC, serializing with orjson when it is available
+
+    Falls back to session.push_to_apic for certificate auth. Logs in again
+    and retries once when the session has expired.
+
+    Returns:
+        requests.Response: Response from APIC
+    """
+    if orjson is None or getattr(session, 'cert_auth', False):
+        return session.push_to_apic(url, data)
+    post_url = session.api + url
+    logging.debug('Posting url: %s data: %s', post_url, data)
+    post_args = {
+        'data': orjson.dumps(data),
+        'headers': {'Content-Type': 'application/json'},
+        'verify': session.verify_ssl,
+        'proxies': getattr(session, '_proxies', None),
+    }
+    resp = session.session.post(post_url, **post_args)
+    if resp.status_code == 403:
+        logging.error('Session expired, logging in to APIC again')
+        session.login()
+        resp = session.session.post(post_url, **post_args)
+    logging.debug('Response: %s %s', resp, resp.text)
+    return resp
+
+
+def migrate_parameters(tenant, app_name):
+    """Migrate interface folders, ip addresses, zones, vlans and default gateways
+
+    All parameter migrations are done in a single walk of the AppProfile.
 
     Args:
         tenant (aci.Tenant): The tenant to modify
@@ -256,46 +346,99 @@ def migrate_default_gateway(tenant, app_name):
     if not app:
         print('Error getting AppProfile: {0}'.format(app_name))
         return False
-    epgs = app.get_children(aci.EPG)
+    epgs = _children(app, aci.EPG)
     for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
+        for folder in _children(epg, aci.Folder):
+            if folder.key == 'InterfaceConfig' and not folder.name.endswith(PREMIGRATION):
+                changes_made = True
+                print_migration(folder, tenant.name, app.name, epg.name)
+                # Copy the folder to make a backup
+                backup = _clone_folder(folder, epg, folder.name + PREMIGRATION)
+                backup.ctrctNameOrLbl += PREMIGRATION
+                # Modify the folder it is DP 1.3 compatible
+                folder.key = 'Interface'
+                subfolders = _children(folder, aci.Folder)
+                for subfolder in subfolders:
+                    new_key = SUBFOLDER_KEYS.get(subfolder.key)
+                    if new_key is None:
+                        continue
+                    print_migration(subfolder, tenant.name, app.name, epg.name, '/'+folder.name)
+                    subfolder.key = new_key
             if folder.key != 'Interface':
                 continue
-            layerfolders = folder.get_children(aci.Folder)
+            layerfolders = _children(folder, aci.Folder)
             for layerfolder in layerfolders:
                 if layerfolder.key not in ('Layer3Interface', 'Layer2Interface'):
                     continue
-                for param in layerfolder.get_children(aci.Parameter):
-                    if param.key != 'default_gateway':
+                for param in _children(layerfolder, aci.Parameter):
+                    if param.key == 'ipv4_address' and layerfolder.key == 'Layer3Interface':
+                        migrate = _migrate_ip
+                    elif param.key in ('security_zone', 'bridge_domain'):
+                        migrate = _migrate_zone_or_vlan
+                    elif param.key == 'default_gateway':
+                        migrate = _migrate_default_gateway
+                    else:
                         continue
                     changes_made = True
                     print_migration(param, tenant.name, app.name, epg.name, '/'+folder.name+'/'+layerfolder.name)
                     # Delete the current in-memory parameter
-                    #layerfolder.remove_child(param)
-                    param.mark_as_deleted()
-                    # Create a new Static Route
-                    new_folder = aci.Folder('default_gateway', epg)
-                    new_folder.ctrctNameOrLbl = folder.ctrctNameOrLbl
-                    new_folder.devCtxLbl = folder.devCtxLbl
-                    new_folder.graphNameOrLbl = folder.graphNameOrLbl
-                    new_folder.nodeNameOrLbl = folder.nodeNameOrLbl
-                    new_folder.scopedBy = folder.scopedBy
-                    new_folder.key = 'StaticRoute'
-                    # Add parameters to StaticRoute folder
-                    nexthop = aci.Parameter('nexthop', new_folder)
-                    nexthop.key = 'nexthop'
-                    nexthop.value = param.value
-                    destination = aci.Parameter('destination', new_folder)
-                    destination.key = 'destination'
-                    destination.value = '0.0.0.0/0'
-                    # Create relation layer folder to point at new folder
-                    relation = aci.Relation('static_route_rel', layerfolder)
-                    relation.key = 'static_route'
-                    relation.targetName = new_folder.name
                     param.mark_as_deleted()
+                    migrate(epg, folder, layerfolder, param)
     return changes_made
 
 
+def _copy_scope(src, dst):
+    """Copy the attributes that scope a folder to a graph node"""
+    for attr in ('ctrctNameOrLbl', 'devCtxLbl', 'graphNameOrLbl', 'nodeNameOrLbl', 'scopedBy'):
+        setattr(dst, attr, getattr(src, attr, None))
+
+
+def _migrate_ip(epg, folder, layerfolder, param):
+    # Create new param with different key for IP
+    new_ip = aci.Parameter('ip', layerfolder)
+    new_ip.key = 'ip'
+    new_ip.value = param.value
+
+
+def _migrate_zone_or_vlan(epg, folder, layerfolder, param):
+    # Create a new Vlan or Zone folder
+    new_folder = aci.Folder(param.value, epg)
+    _copy_scope(folder, new_folder)
+    new_ref_key = ''
+    if param.key == 'bridge_domain':
+        new_ref_key = 'vlan'
+        new_folder.key = 'Vlan'
+    elif param.key == 'security_zone':
+        new_ref_key = 'zone'
+        # For zones, add a mode parameter
+        new_folder.key = 'Zone'
+        layer = aci.Parameter('mode', new_folder)
+        layer.key = 'mode'
+        layer.value = layerfolder.key[:6].lower()  # 'layer3' or 'layer2'
+    # Create relation layer folder to point at new folder
+    relation = aci.Relation(param.key+'_rel', layerfolder)
+    relation.key = new_ref_key
+    relation.targetName = new_folder.name
+
+
+def _migrate_default_gateway(epg, folder, layerfolder, param):
+    # Create a new Static Route
+    new_folder = aci.Folder('default_gateway', epg)
+    _copy_scope(folder, new_folder)
+    new_folder.key = 'StaticRoute'
+    # Add parameters to StaticRoute folder
+    nexthop = aci.Parameter('nexthop', new_folder)
+    nexthop.key = 'nexthop'
+    nexthop.value = param.value
+    destination = aci.Parameter('destination', new_folder)
+    destination.key = 'destination'
+    destination.value = '0.0.0.0/0'
+    # Create relation layer folder to point at new folder
+    relation = aci.Relation('static_route_rel', layerfolder)
+    relation.key = 'static_route'
+    relation.targetName = new_folder.name
+
+
 def _next_level(children, dn, object_key, reference):
     dn_split = dn.split('/', 1)
     level = dn_split[0].split('-', 1)
@@ -306,12 +449,10 @@ def _next_level(children, dn, object_key, reference):
     if key == 'vnsAbsFConn':
         key = 'vnsAbsFuncConn'
     name = level[1]
-    found = False
-    for c in children:
-        if key in c and c[key]['attributes']['name'] == name:
-            new_children = c[key]['children']
-            found = True
-    if not found:
+    # Share the parent MO with relations already added under it
+    new_children = next((c[key]['children'] for c in children
+                         if key in c and c[key]['attributes']['name'] == name), None)
+    if new_children is None:
         new_child = {key: {'attributes': {'name': name},
                            'children': []}}
         children.append(new_child)
@@ -319,27 +460,33 @@ def _next_level(children, dn, object_key, reference):
     return _next_level(new_children, dn_split[1], object_key, reference)
 
 
-def migrate_clusters(tenant, session):
+def _retarget_clusters(tenant, cluster_rels, from_version, to_version, action):
+    """Point cluster relations at another version of the device package"""
+    pattern = DP_REFERENCES[from_version]
+    replacement = r"uni/infra/\g<1>-PaloAltoNetworks-\g<2>-" + to_version
+    result = []
+    for cluster in cluster_rels:
+        key = next(iter(cluster))
+        attributes = cluster[key]['attributes']
+        if pattern.match(attributes['tDn']):
+            print_migration(cluster, tenant.name, '', '', action=action)
+            reference = pattern.sub(replacement, attributes['tDn'])
+            dn = attributes['dn'].split('/', 2)[2]
+            _next_level(result, dn, key, reference)
+    return result
+
+
+def migrate_clusters(tenant, cluster_rels):
     """Migrate clusters to new device package
 
     Args:
         tenant (aci.Tenant): The tenant to modify
+        cluster_rels (list): Cluster relations from get_clusters
 
     Returns:
-        bool: True if changes made, False if no changes made
+        list: Children of the tenant MO, with relations sharing parent MOs merged
     """
-    result = []
-    cluster_rels = get_clusters(session, tenant)
-    for cluster in cluster_rels:
-        key = cluster.keys()[0]
-        attributes = cluster[key]['attributes']
-        pattern = r"^uni/infra/(mDev|mDevMgr|mChassis)-PaloAltoNetworks-(PANOS|Panorama|Chassis)-1.2"
-        if re.match(pattern, attributes['tDn']):
-            print_migration(cluster, tenant.name, '', '', action='Upgrading DP Reference to 1.3:')
-            reference = re.sub(pattern, "uni/infra/\g<1>-PaloAltoNetworks-\g<2>-1.3", attributes['tDn'])
-            dn = attributes['dn'].split('/', 2)[2]
-            _next_level(result, dn, key, reference)
-    return result
+    return _retarget_clusters(tenant, cluster_rels, '1.2', '1.3', 'Upgrading DP Reference to 1.3:')
 
 
 def cleanup_interface_folders(tenant, app_name):
@@ -357,10 +504,10 @@ def cleanup_interface_folders(tenant, app_name):
     if not app:
         print('Error getting AppProfile: {0}'.format(app_name))
         return False
-    epgs = app.get_children(aci.EPG)
+    epgs = _children(app, aci.EPG)
     for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
-            if folder.key == 'InterfaceConfig' and folder.name.endswith('_premigration'):
+        for folder in _children(epg, aci.Folder):
+            if folder.key == 'InterfaceConfig' and folder.name.endswith(PREMIGRATION):
                 print_migration(
                     object=folder,
                     tenant=tenant.name,
@@ -391,9 +538,9 @@ def delete_migrated_folders(tenant, app_name):
     if not app:
         print('Error getting AppProfile: {0}'.format(app_name))
         return False
-    epgs = app.get_children(aci.EPG)
+    epgs = _children(app, aci.EPG)
     for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
+        for folder in _children(epg, aci.Folder):
             if folder.key in ('Interface', 'Zone', 'Vlan', 'StaticRoute'):
                 # Delete all 1.3 parameters
                 print_migration(object=folder, tenant=tenant.name, app=app.name, epg=epg.name, action='Deleting')
@@ -405,6 +552,10 @@ def delete_migrated_folders(tenant, app_name):
 def revert_interface_folders(tenant, app_name):
     """Revert Parameters back to the way they were
 
+    The 1.3 Interface folder with the same name as a backup is restored in
+    place, so this must run before delete_migrated_folders and both can be
+    pushed together.
+
     Warnings:
         Cannot be done after a cleanup action!
 
@@ -420,152 +571,187 @@ def revert_interface_folders(tenant, app_name):
     if not app:
         print('Error getting AppProfile: {0}'.format(app_name))
         return False
-    epgs = app.get_children(aci.EPG)
+    epgs = _children(app, aci.EPG)
     for epg in epgs:
-        for folder in epg.get_children(aci.Folder):
-            if folder.key in ('Interface', 'Zone', 'Vlan', 'StaticRoute'):
-                epg.remove_child(folder)
-        for folder in epg.get_children(aci.Folder):
-            if folder.name.endswith('_premigration'):
+        folders = _children(epg, aci.Folder)
+        folders_by_name = {f.name: f for f in folders}
+        for folder in folders:
+            if folder.name.endswith(PREMIGRATION):
                 # Restore backup of 1.2 parameters
                 print_migration(object=folder, tenant=tenant.name, app=app.name, epg=epg.name, action='Reverting')
                 changes_made = True
-                backup = deepcopy(folder)
-                epg.add_child(backup)
-                backup.mark_as_deleted()
-                folder.name = folder.name[:-13]
-                folder.ctrctNameOrLbl = folder.ctrctNameOrLbl[:-13]
+                migrated = folders_by_name.get(folder.name[:-len(PREMIGRATION)])
+                if migrated is not None:
+                    _restore_folder(migrated, folder)
+                    folder.mark_as_deleted()
+                    continue
+                # Rename the backup in place, then delete its old name with a childless stub.
+                # The stub is created after the rename, or acitoolkit would replace the
+                # backup with it since they have the same name.
+                backup_name = folder.name
+                backup_ctrct = folder.ctrctNameOrLbl
+                folder.name = folder.name[:-len(PREMIGRATION)]
+                folder.ctrctNameOrLbl = folder.ctrctNameOrLbl[:-len(PREMIGRATION)]
+                stub = aci.Folder(backup_name, epg)
+                stub.key = folder.key
+                _copy_scope(folder, stub)
+                stub.ctrctNameOrLbl = backup_ctrct
+                stub.mark_as_deleted()
+                _clear_children(epg)
     return changes_made
 
 
-def revert_clusters(tenant, session):
-    """Migrate clusters to new device package
+def revert_clusters(tenant, cluster_rels):
+    """Revert clusters to old device package
 
     Args:
         tenant (aci.Tenant): The tenant to modify
+        cluster_rels (list): Cluster relations from get_clusters
 
     Returns:
-        bool: True if changes made, False if no changes made
+        list: Children of the tenant MO, with relations sharing parent MOs merged
     """
-    result = []
-    cluster_rels = get_clusters(session, tenant)
-    for cluster in cluster_rels:
-        key = cluster.keys()[0]
-        attributes = cluster[key]['attributes']
-        pattern = r"^uni/infra/(mDev|mDevMgr|mChassis)-PaloAltoNetworks-(PANOS|Panorama|Chassis)-1.3"
-        if re.match(pattern, attributes['tDn']):
-            print_migration(cluster, tenant.name, '', '', action='Reverting DP Reference to 1.2:')
-            reference = re.sub(pattern, "uni/infra/\g<1>-PaloAltoNetworks-\g<2>-1.2", attributes['tDn'])
-            dn = attributes['dn'].split('/', 2)[2]
-            _next_level(result, dn, key, reference)
-    return result
+    return _retarget_clusters(tenant, cluster_rels, '1.3', '1.2', 'Reverting DP Reference to 1.2:')
 
 
-def main():
-    args = parse_args()
-    session = aci.Session(args.url, args.login, args.password)
-    resp = session.login()
-    if not resp.ok:
-        print('%% Could not login to APIC')
-        sys.exit(1)
+def migrate_tenant(session, args, tenant_name):
+    """Perform the requested actions on one tenant
 
-    # Collect list of tenants from APIC
-    tenants = aci.Tenant.get(session)
-    if not args.tenant:
-        # Print tenants and exit
-        print('\nPlease specify a tenant with --tenant TENANT_NAME')
-        print_object_names(tenants, 'Tenants')
-        sys.exit(0)
+    Args:
+        session (aci.Session): Logged in APIC session, used only by this tenant
+        args: Parsed command line arguments
+        tenant_name (str): Name of the tenant
 
-    tenant = [t for t in tenants if t.name == args.tenant]
-    if not tenant:
-        print('Tenant {0} not found on APIC'.format(args.tenant))
-        sys.exit(1)
-    tenant = tenant[0]
+    Returns:
+        bool: True if successful, False if there was an error
+    """
+    # Pull the tenant, its AppProfiles, and its clusters in one request
+    data = get_tenant_config(session, tenant_name)
+    if not data:
+        print('Tenant {0} not found on APIC'.format(tenant_name))
+        return False
 
-    # Collect list of apps from APIC
-    apps = aci.AppProfile.get(session, tenant)
+    app_names = set(get_app_names(data))
     if (args.parameters or args.cleanup) and not args.app:
-        # Print apps and exit
+        # Print apps and stop
         print('\nPlease specify an AppProfile with --app APP_NAME')
-        print_object_names(apps, 'AppProfiles')
-        sys.exit(0)
+        print_object_names(sorted(app_names), 'AppProfiles in tenant {0}'.format(tenant_name))
+        return True
 
     if args.parameters or args.cleanup:
-        app = [a for a in apps if a.name == args.app]
-        if not app:
-            print('AppProfile {0} not found on APIC'.format(args.app))
-            sys.exit(1)
-        app = app[0]
-
-
-    if args.dry_run:
-        print('This is a dry-run, so none of the following is actually happening...')
-
-    if args.parameters or args.cleanup or (args.revert and args.parameters):
-        # Pull entire tenant config with folders, params, and relations
-        tenant = aci.Tenant.get_deep(session, [args.tenant], ['vnsFolderInst'], config_only=True)[0]
+        if args.app not in app_names:
+            print('AppProfile {0} not found in tenant {1} on APIC'.format(args.app, tenant_name))
+            return False
+
+    update_tenant = args.parameters or args.cleanup
+    if update_tenant:
+        # Pull folders, params, and relations of the AppProfile being migrated
+        app_data = get_app_config(session, tenant_name, args.app)
+        folder_keys = get_folder_keys(app_data)
+        tenant = build_tenant(tenant_name, app_data)
     else:
-        tenant = aci.Tenant(args.tenant)
+        # Only clusters are pushed, so leave the tenant config alone
+        folder_keys = set()
+        tenant = aci.Tenant(tenant_name)
 
 
     changes_made = False
     # Perform in-memory migration
-    if args.parameters and not args.revert:
-        changes_made = migrate_interface_folder_keys(tenant, args.app) or changes_made
-        changes_made = migrate_ip(tenant, args.app) or changes_made
-        changes_made = migrate_zones_and_vlans(tenant, args.app) or changes_made
-        changes_made = migrate_default_gateway(tenant, args.app) or changes_made
+    if args.parameters and not args.revert and folder_keys & {'InterfaceConfig', 'Interface'}:
+        changes_made = migrate_parameters(tenant, args.app) or changes_made
+        _clear_children()
 
     clusters = []
+    cluster_rels = get_clusters(data) if args.clusters else []
     if args.clusters and not args.revert:
-        clusters = migrate_clusters(tenant, session)
+        clusters = migrate_clusters(tenant, cluster_rels)
         if clusters:
             changes_made = True
 
     # Cleanup old 1.2 parameters (after migration)
-    if args.cleanup and not args.revert:
+    if args.cleanup and not args.revert and 'InterfaceConfig' in folder_keys:
         changes_made = cleanup_interface_folders(tenant, args.app) or changes_made
+        _clear_children()
 
     # Revert to 1.2 parameters
-    if args.revert and args.parameters:
-        changes_made = delete_migrated_folders(tenant, args.app) or changes_made
-        if not args.dry_run and changes_made:
-            resp = session.push_to_apic(tenant.get_url(), tenant.get_json())
-            if not resp.ok:
-                print('%% Error: Could not push configuration to APIC')
-                print(resp.text)
-                sys.exit(1)
-            else:
-                print('Pushed changes to APIC')
+    if args.revert and args.parameters and folder_keys & {'InterfaceConfig', 'Interface', 'Zone', 'Vlan', 'StaticRoute'}:
+        # Restore 1.2 folders first so only what is left of 1.3 gets deleted
         changes_made = revert_interface_folders(tenant, args.app) or changes_made
+        changes_made = delete_migrated_folders(tenant, args.app) or changes_made
+        _clear_children()
 
     if args.revert and args.clusters:
-        clusters = revert_clusters(tenant, session)
+        clusters = revert_clusters(tenant, cluster_rels)
         if clusters:
             changes_made = True
 
     # Assemble json
-    json = tenant.get_json()
-    if args.clusters and clusters:
+    if update_tenant:
+        json = tenant.get_json()
         json['fvTenant']['children'].extend(clusters)
+    else:
+        # Only clusters are pushed, no need to serialize the tenant object
+        json = {'fvTenant': {'attributes': {'name': tenant.name}, 'children': clusters}}
     if args.debug:
         from pprint import pprint
         pprint(json)
     # Apply changes to APIC
     if not args.dry_run:
         if changes_made:
-            resp = session.push_to_apic(tenant.get_url(), json)
+            resp = push_to_apic(session, tenant.get_url(), json)
             if not resp.ok:
-                print('%% Error: Could not push configuration to APIC')
+                print('%% Error: Could not push configuration for tenant {0} to APIC'.format(tenant_name))
                 print(resp.text)
-                sys.exit(1)
+                return False
             else:
                 print('Pushed changes to APIC')
         else:
             print('No changes made')
     else:
         print('Skipping push to APIC due to dry-run mode')
+    return True
+
+
+def main():
+    args = parse_args()
+    session = aci.Session(args.url, args.login, args.password)
+    resp = session.login()
+    if not resp.ok:
+        print('%% Could not login to APIC')
+        sys.exit(1)
+
+    if not args.tenant:
+        # Print tenants and exit
+        tenants = aci.Tenant.get(session)
+        print('\nPlease specify a tenant with --tenant TENANT_NAME')
+        print_object_names([t.name for t in tenants], 'Tenants')
+        sys.exit(0)
+
+    if args.dry_run:
+        print('This is a dry-run, so none of the following is actually happening...')
+
+    tenant_names = [name.strip() for name in args.tenant.split(',') if name.strip()]
+    if len(tenant_names) == 1:
+        results = [migrate_tenant(session, args, tenant_names[0])]
+    else:
+        # APIC calls are I/O bound, so migrate tenants in parallel threads.
+        # Sessions are not thread-safe, so each tenant after the first gets its own.
+        def _migrate(item):
+            index, tenant_name = item
+            if index == 0:
+                return migrate_tenant(session, args, tenant_name)
+            tenant_session = aci.Session(args.url, args.login, args.password)
+            if not tenant_session.login().ok:
+                print('%% Could not login to APIC for tenant {0}'.format(tenant_name))
+                return False
+            return migrate_tenant(tenant_session, args, tenant_name)
+        pool = ThreadPool(min(MAX_TENANT_THREADS, len(tenant_names)))
+        try:
+            results = pool.map(_migrate, list(enumerate(tenant_names)))
+        finally:
+            pool.close()
+    if not all(results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':